@@ -1,15 +1,32 @@
-from typing import List, Dict
-
+import copy
+import hashlib
+import random
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
+from itertools import repeat
+from typing import List, Dict, Set, Tuple, Union, Iterator, Optional
+
+import numpy as np
+import pandas as pd
 from tqdm.auto import tqdm
 from kneed import KneeLocator
 import plotly.express as px
 from mini_memgraph import Memgraph
+from mini_memgraph.utility import chunks
+from squashy.io import AssignmentCache
+from squashy.utility import read_scalar, iter_read
 from squashy.metrics import AgglomeratorMetrics
 
 
 class GraphAgglomerator:
     degree_label = 'agglom_degree'
-    final_assignments: Dict
+    eligible_label = 'AGGLOM_ELIGIBLE'
+    save_chunk_size = 50000
+    expansion_chunk_size = 10000
     _minimum_degree = None
     degree_attr_exists: bool
     _node_label = None
@@ -18,17 +35,54 @@ class GraphAgglomerator:
     _represents_label = 'REPRESENTS'
     _hops = (1, 3)
     current_hop: int = 0
+    _frontier: Dict[int, Dict[int, float]]
+    _visited: Dict[int, Set[int]]
+    _frontier_hop: int = 0
+    _frontier_rings: Dict[int, Dict[int, Dict[int, float]]]
+    _frontier_rings_key: Optional[Tuple] = None
+    _graph_size_cache: Dict[Tuple, int]
+    _assign_node: np.ndarray
+    _assign_core: np.ndarray
+    _assign_dist: np.ndarray
+    _assigned: Set[int]
+    _n: int = 0
+    _n_saved: int = 0
+    _cores: Optional[List[int]] = None
+    _n_cores: int = 0
+    _pending: Dict[int, Tuple[int, float, int]]
+    _expansion_query: str
+    _weight = None
+    _query_cache: Dict[str, str]
+    _executor: Optional[ThreadPoolExecutor] = None
+    _csr: Optional[Tuple] = None
 
     def __init__(self, database: Memgraph, node_label: str,
                  rel_label: str, core_label: str = 'CORE', weight:str=None,
-                 orientation: str = 'undirected', min_hops: int = 1, max_hops: int = 3):
+                 orientation: str = 'undirected', min_hops: int = 1, max_hops: int = 3,
+                 batch_size: Optional[int] = 500, n_workers: Optional[int] = 4, assignments_path: str = None,
+                 tie_break: str = 'first', seed: int = None, in_memory: bool = False,
+                 keep_frontier_rings: bool = False):
 
         self.database = database
+        self._query_cache = {}
         self.metrics = AgglomeratorMetrics(self.database)
         self.set_node_label(node_label)
         self.set_rel_label(rel_label)
         self.set_core_label(core_label)
         self.weight = weight
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.in_memory = in_memory
+        self.keep_frontier_rings = keep_frontier_rings
+        self._worker_local = threading.local()
+        if tie_break not in ('first', 'random'):
+            raise ValueError(f'tie_break must be either "first" or "random". {tie_break=}')
+        self.tie_break = tie_break
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._frontier_rings = {}
+        self._graph_size_cache = {}
+        self._assignment_cache = AssignmentCache(assignments_path) if assignments_path is not None else None
         self._original_hop_options = (min_hops, max_hops)
         self.set_hop_range(min_hops=min_hops, max_hops=max_hops)
 
@@ -39,9 +93,12 @@ class GraphAgglomerator:
             self._left_endpoint = '<-'
         elif orientation == 'out':
             self._right_endpoint = '->'
-        self.total_nodes = self.calculate_graph_size()
-
+        self._ensure_indexes()
 
+    def _ensure_indexes(self):
+        self.database.set_index(self._node_label, 'id')
+        self.database.set_index(self._core_label, 'id')
+        self.database.set_index(self.metrics.node_label, 'hop')
 
     def _is_resuming(self) -> bool:
         return self.metrics.pass_ > 0
@@ -55,17 +112,22 @@ class GraphAgglomerator:
                 print('Agglomeration incomplete.')
                 print(f'Use .agglomerate() to restart hop {self.current_hop}.')
                 print('Use .reset() to restart from the beginning')
-                self.database._disconnect()
+                getattr(self.database, 'close', self.database._disconnect)()
         return report_and_exit
 
     def _initialize(self):
         self._check_label(self.core_label)
         self.current_hop = 0
-        self.final_assignments = {c: c for c in self.cores}
-        self.final_assignments = self._reshape_assignments(self.final_assignments)
-        self.final_assignments = self._add_distance(self.final_assignments)
+        self.database.wipe_relationships(self._represents_label)
+        if self.minimum_degree is not None:
+            self._materialize_candidate_label()
+        if self._assignment_cache is not None:
+            self._assignment_cache.clear(self._cache_key())
+        self._clear_assignments()
+        self._add_assignments(self.cores, self.cores, self.current_hop)
         self._save_assignments()
-        self._progress_tracker = set(self.cores)
+        self._pending = {}
+        self._reset_frontier()
 
     def _resume(self):
         complete = self.list_complete_hops()
@@ -77,18 +139,33 @@ class GraphAgglomerator:
             start_hop = 0
         self.set_minimum_hop(start_hop)
         self.drop_incomplete_hop_rels(start_hop)
+        if self._assignment_cache is not None:
+            self._assignment_cache.drop_from_distance(start_hop)
         self.drop_incomplete_hop_metrics(start_hop)
-        self.final_assignments = self.load_assignments()
-        self._progress_tracker = set(self.final_assignments.keys())
+        self._clear_assignments()
+        assignments = self.load_assignments()
+        cache = self._assignment_cache
+        if cache is not None and cache.run_key != self._cache_key():
+            cache.clear(self._cache_key())
+            cache.append((node, data['core'], data['distance']) for node, data in assignments.items())
+        self._add_assignments(list(assignments.keys()),
+                              [data['core'] for data in assignments.values()],
+                              [data['distance'] for data in assignments.values()])
+        self._n_saved = self._n
+        self._pending = {}
+        self._reset_frontier()
         self.metrics.local_pass_ = 0
         self.metrics.load_metrics()
 
     def list_complete_hops(self) -> List[int]:
-        n_cores = len(self.cores)
         metric_node_label = self.metrics.node_label
-        counts = self.database.read(f'MATCH (n:{metric_node_label}) RETURN n.hop AS hop, count(n) AS freq')
-        complete = [record['hop'] for record in counts if record['freq'] == n_cores]
-        return complete
+        match_q = f'MATCH (n:{metric_node_label})'
+        with_q = 'WITH n.hop AS hop, max(n.n_cores) AS n_done WHERE n_done = $n_cores'
+        return_q = 'RETURN hop'
+        counts = self.database.read(' '.join([match_q, with_q, return_q]), n_cores=self.n_cores)
+        if counts is None:
+            return []
+        return [record['hop'] for record in counts]
 
     def drop_incomplete_hop_rels(self, max_hop_val: int):
         self.database.write(
@@ -102,19 +179,40 @@ class GraphAgglomerator:
         self.database.write(query=f'MATCH (n:META:{self.metrics.node_label}) WHERE n.hop >= $max_hop_val DELETE n',
                             max_hop_val=max_hop_val)
 
+    def count_saved_assignments(self) -> int:
+        return read_scalar(
+            self.database,
+            f"MATCH (:{self.core_label})-[r:{self.represents_label}]->(:{self.node_label}) RETURN count(r) AS n_rels",
+            'n_rels', default=0
+        )
+
+    def has_assignments(self) -> bool:
+        query = f"MATCH (:{self.core_label})-[r:{self.represents_label}]->(:{self.node_label}) RETURN id(r) AS id LIMIT 1"
+        return read_scalar(self.database, query, 'id') is not None
+
+    def _cache_key(self) -> str:
+        run = (self._node_label, self._rel_label, self._core_label, self.orientation, self.weight,
+               self.minimum_degree, self.tie_break, self.seed, sorted(map(repr, self.cores)))
+        return hashlib.blake2b(repr(run).encode(), digest_size=16).hexdigest()
+
     def load_assignments(self):
+        cache = self._assignment_cache
+        if cache is not None and cache.run_key == self._cache_key() and \
+                cache.count() == self.count_saved_assignments():
+            return {node: dict(distance=distance, core=core) for node, core, distance in cache.load()}
         assignments = self.database.read(
             query=f"MATCH (c:{self.core_label})-[r:{self.represents_label}]->(n:{self.node_label})"
                   " RETURN c.id AS core, n.id AS node, r.distance AS distance"
         )
         return {record['node']:dict(
             distance=record['distance'],
-            core=record['core']) for record in assignments}
+            core=record['core']) for record in assignments or []}
 
     def _set_label(self, attr: str, label: str):
         if not isinstance(label, str):
             raise ValueError
         setattr(self, attr, label)
+        self._rebuild_queries()
 
     def _check_label(self, label: str):
         if not self.database.label_exists(label):
@@ -122,6 +220,7 @@ class GraphAgglomerator:
 
     def set_core_label(self, label: str):
         self._set_label('_core_label', label)
+        self._cores = None
 
     def set_represents_label(self, label: str):
         self._set_label('_represents_label', label)
@@ -144,6 +243,20 @@ class GraphAgglomerator:
     def set_minimum_degree(self, degree: int, recalculate=False):
         self._minimum_degree = degree
         self._calculate_degree(recalculate)
+        self._materialize_candidate_label()
+        self._rebuild_queries()
+        self._frontier_rings = {}
+        if recalculate:
+            self._graph_size_cache = {}
+
+    def _materialize_candidate_label(self):
+        self.database.remove_node_label(self.eligible_label)
+        if self.minimum_degree is None:
+            return
+        self.database.write(f"MATCH (u:{self._node_label}) WHERE u.{self.degree_label} >= $min_degree "
+                            f"SET u:{self.eligible_label}",
+                            min_degree=self.minimum_degree)
+        self.database.set_index(self.eligible_label)
 
     def set_hop_range(self, max_hops: int = 3, min_hops: int = 1):
         hop_range = (min_hops, max_hops)
@@ -159,7 +272,10 @@ class GraphAgglomerator:
         min_hop = self._hops[0]
         self.set_hop_range(min_hops=min_hop, max_hops=max_hop)
 
-    def calculate_graph_size(self):
+    def calculate_graph_size(self, recalculate=False):
+        size_key = (self._node_label, self._rel_label, self.orientation, self.minimum_degree)
+        if not recalculate and size_key in self._graph_size_cache:
+            return self._graph_size_cache[size_key]
         if self.minimum_degree is not None:
             self._calculate_degree()
             total_nodes_where = f"WHERE u.{self.degree_label} >= {self.minimum_degree}"
@@ -169,53 +285,80 @@ class GraphAgglomerator:
         total_nodes_with = f'WITH DISTINCT u'
         total_nodes_return = 'RETURN count(u) AS n_nodes'
         total_nodes_query = ' '.join([total_nodes_match, total_nodes_where, total_nodes_with, total_nodes_return])
-        n_total_nodes = self.database.read(total_nodes_query)[0]['n_nodes']
+        n_total_nodes = read_scalar(self._worker_database(), total_nodes_query, 'n_nodes', default=0)
+        self._graph_size_cache[size_key] = n_total_nodes
         return n_total_nodes
 
     def _update_metrics(self):
-        self.metrics.graph_size = self.total_nodes
-        self.metrics.n_assigned = len(self._progress_tracker)
-        self.metrics.ratio = round(self.metrics.n_assigned / self.total_nodes, 4)
+        total_nodes = self.total_nodes
+        self.metrics.graph_size = total_nodes
+        self.metrics.n_assigned = self._n + len(self._pending)
+        self.metrics.ratio = round(self.metrics.n_assigned / total_nodes, 4)
 
     def _get_hop_options(self):
         return list(range(self._hops[0], self._hops[1]+1))
 
     @elegant_exit
     def agglomerate(self):
+        requested_hops = self._hops
+        try:
+            return self._agglomerate()
+        finally:
+            self._hops = requested_hops
+
+    def _agglomerate(self):
+        self.refresh_cores()
+        self._expansion_query = self._get_query('expansion')
         if self._is_resuming():
             self._resume()
         else:
             self._initialize()
-        current_assignments = {}
+        if self.minimum_degree is not None:
+            self._drop_unreachable_cores()
+        self._csr = self._load_adjacency() if self.in_memory else None
         hop_options = self._get_hop_options()
         n_hops = len(hop_options)
-        bar_total = len(self.cores) * n_hops
+        n_cores = self.n_cores
+        bar_total = n_cores * n_hops
 
-        with tqdm(total=bar_total) as bar:
+        metrics = self.metrics
+        update_metrics = self._update_metrics
+        find = self._find_represented_nodes_batch
+        organize = self._organize_assignments
+
+        with tqdm(total=bar_total) as bar, self._expansion_pool(), self._run_state():
             for hop in hop_options:
+                self._advance_frontier(hop if hop in self._frontier_rings else hop - 1)
                 self.current_hop = hop
-                for i, core in enumerate(self.cores, start=1):
-                    self._update_metrics()
-                    self.metrics.hop = hop
-                    self.metrics.n_cores = i
-
-                    report = self.metrics.report()
-                    bar.set_description(f'Core {i}/{len(self.cores)} | Hop Distance:{hop} | {str(report)}')
-
-                    self.metrics.start_timer()
-                    caught_nodes = self._find_represented_nodes(core, min_hops=hop, max_hops=hop)
-                    id_list = [node['id'] for node in caught_nodes]
-                    self._track_assignments(id_list)
-                    current_assignments = self._organize_assignments(core, current_assignments, caught_nodes)
-                    self.metrics.stop_timer()
-                    self.metrics.new_record()
-                    bar.update(1)
-
-                current_assignments = self._deduplicate_assignments(current_assignments)
-                current_assignments = self._select_closest_core(current_assignments)
-                current_assignments = self._reshape_assignments(current_assignments)
-                current_assignments = self._add_distance(current_assignments)
-                self.final_assignments.update(current_assignments)
+                core_batches = self._live_core_batches()
+                n_batches = len(core_batches)
+                describe_every = max(1, n_batches // 200)
+                description = f'Core %d/{n_cores} | Hop Distance:{hop} | %s'
+                n_done = n_cores - sum(len(core_batch) for core_batch in core_batches)
+                bar.update(n_done)
+                if hop > self._frontier_hop:
+                    expansions = self._iter_expansions(core_batches)
+                else:
+                    expansions = repeat(None)
+                for i, core_batch in enumerate(core_batches, start=1):
+                    n_done += len(core_batch)
+                    update_metrics()
+                    metrics.hop = hop
+                    metrics.n_cores = n_done
+
+                    if i % describe_every == 0 or i == n_batches:
+                        report = metrics.report()
+                        bar.set_description(description % (n_done, report), refresh=False)
+
+                    metrics.start_timer()
+                    organize(find(core_batch, next(expansions)))
+                    metrics.stop_timer()
+                    metrics.new_record()
+                    bar.update(len(core_batch))
+
+                self._set_frontier_hop(hop)
+                self._add_assignments(list(self._pending), [best[0] for best in self._pending.values()], hop)
+                self._pending = {}
 
                 self._save_assignments()
             self._calculate_n_subnodes()
@@ -225,74 +368,299 @@ class GraphAgglomerator:
         self.database.set_degree(self.core_label, self.represents_label, self.node_label, set_property='n_subnodes',
                                  orientation='out')
 
+    def _clear_assignments(self):
+        cores = self.cores
+        capacity = max(self.total_nodes, self.n_cores, 1)
+        self._core_ids = np.empty(self.n_cores, dtype=object)
+        self._core_ids[:] = cores
+        self._core_index = {core: i for i, core in enumerate(self._core_ids)}
+        self._assign_node = np.empty(capacity, dtype=object)
+        self._assign_core = np.empty(capacity, dtype=np.int32)
+        self._assign_dist = np.empty(capacity, dtype=np.int32)
+        self._assigned = set()
+        self._n = 0
+        self._n_saved = 0
+
+    def _add_assignments(self, nodes: List, cores: List, distance: Union[int, List[int]]):
+        n_new = len(nodes)
+        end = self._n + n_new
+        if end > len(self._assign_node):
+            capacity = max(end, 2 * len(self._assign_node))
+            self._assign_node = np.resize(self._assign_node, capacity)
+            self._assign_core = np.resize(self._assign_core, capacity)
+            self._assign_dist = np.resize(self._assign_dist, capacity)
+        self._assign_node[self._n:end] = nodes
+        self._assign_core[self._n:end] = [self._core_index[core] for core in cores]
+        self._assign_dist[self._n:end] = distance
+        self._assigned.update(nodes)
+        self._n = end
+
     def _save_assignments(self):
-        edge_list = [{'target': node, 'source': data['core'], 'distance': data['distance']} for node, data in self.final_assignments.items() if data['distance'] == self.current_hop]
-        self.database.write_edges(edge_list,
-                                  source_label=self._core_label,
-                                  edge_label=self._represents_label,
-                                  target_label=self._node_label,
-                                  add_attributes=['distance'])
+        if self._n_saved == self._n:
+            return
+        query = self._get_query('save')
+        for start in range(self._n_saved, self._n, self.save_chunk_size):
+            unsaved = slice(start, min(start + self.save_chunk_size, self._n))
+            nodes = self._assign_node[unsaved].tolist()
+            cores = self._core_ids[self._assign_core[unsaved]].tolist()
+            distances = self._assign_dist[unsaved].tolist()
+            rows = [{'target': node, 'source': core, 'distance': distance}
+                    for node, core, distance in zip(nodes, cores, distances)]
+            self.database.write(query, rows=rows)
+            if self._assignment_cache is not None:
+                self._assignment_cache.append(zip(nodes, cores, distances))
+        self._n_saved = self._n
+
+    def _rebuild_queries(self):
+        self._query_cache = {}
+
+    def _get_query(self, name: str) -> str:
+        query = self._query_cache.get(name)
+        if query is None:
+            builders = {'expansion': self._build_expansion_query, 'save': self._build_save_query}
+            query = self._query_cache[name] = builders[name]()
+        return query
+
+    def _build_save_query(self) -> str:
+        unwind = "UNWIND $rows AS row"
+        match = f"MATCH (s:{self._core_label} {{id:row.source}}), (t:{self._node_label} {{id:row.target}})"
+        create = f"CREATE (s)-[:{self._represents_label} {{distance: row.distance}}]->(t)"
+        return ' '.join([unwind, match, create])
 
     def reset(self):
         self.database.wipe_relationships(self._represents_label)
+        self.database.remove_node_label(self.eligible_label)
+        if self._assignment_cache is not None:
+            self._assignment_cache.clear()
+        self._frontier_rings = {}
         self.metrics = self.metrics.reset_metrics()
 
     def _calculate_degree(self, force=False):
         if not self.degree_attr_exists or force:
-            self.database.set_degree(self._node_label, self._rel_label, set_property=self.degree_label, orientation=self.orientation)
+            self._worker_database().set_degree(self._node_label, self._rel_label, set_property=self.degree_label,
+                                               orientation=self.orientation)
             self.degree_attr_exists = True
 
-    def _find_represented_nodes(self, core_id: int, min_hops:int=1, max_hops:int=6) -> List[Dict]:
+    def _reset_frontier(self):
+        cores = self.cores
+        rings_key = (self._expansion_query, self.minimum_degree, tuple(cores))
+        if rings_key != self._frontier_rings_key:
+            self._frontier_rings = {}
+            self._frontier_rings_key = rings_key
+        self._frontier = {c: {c: 0} for c in cores}
+        self._visited = {c: {c} for c in cores}
+        self._frontier_hop = 0
+
+    def _drop_unreachable_cores(self):
+        match = f"MATCH (c:{self._core_label}){self._left_endpoint}[:{self._rel_label}]{self._right_endpoint}" \
+                f"(:{self._node_label}:{self.eligible_label})"
+        result = self.database.read(' '.join([match, "WITH DISTINCT c RETURN c.id AS id"]))
+        reachable = {record['id'] for record in result or []}
+        for core in self.cores:
+            if core not in reachable:
+                self._frontier[core] = {}
+
+    def _advance_frontier(self, hop: int):
+        while self._frontier_hop < hop:
+            next_hop = self._frontier_hop + 1
+            ring = self._frontier_rings.get(next_hop)
+            if ring is not None:
+                self._frontier = dict(ring)
+                for core, nodes in ring.items():
+                    self._visited[core].update(nodes)
+            else:
+                core_batches = self._live_core_batches()
+                for core_batch, records in zip(core_batches, self._iter_expansions(core_batches)):
+                    self._expand_frontier(core_batch, records)
+            self._set_frontier_hop(next_hop)
+
+    def _set_frontier_hop(self, hop: int):
+        self._frontier_hop = hop
+        if self.keep_frontier_rings:
+            self._frontier_rings[hop] = dict(self._frontier)
+
+    def _live_core_batches(self) -> List[List[int]]:
+        live_cores = [core for core in self.cores if self._frontier[core]]
+        batch_size = self.batch_size or max(len(live_cores), 1)
+        return list(chunks(live_cores, batch_size)) or [[]]
+
+    def _worker_database(self) -> Memgraph:
+        if threading.current_thread() is threading.main_thread():
+            return self.database
+        if not hasattr(self._worker_local, 'database'):
+            self._worker_local.database = copy.copy(self.database)
+        return self._worker_local.database
+
+    @contextmanager
+    def _run_state(self):
+        try:
+            yield
+        finally:
+            self._csr = None
+            self._frontier = {}
+            self._visited = {}
+            self._frontier_hop = 0
+            if not self.keep_frontier_rings:
+                self._frontier_rings = {}
+
+    @contextmanager
+    def _expansion_pool(self):
+        n_workers = self.n_workers or 32
+        if n_workers <= 1:
+            yield
+            return
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            self._executor = executor
+            try:
+                yield
+            finally:
+                self._executor = None
+
+    def _iter_expansions(self, core_batches: List[List[int]]) -> Iterator[List[Tuple]]:
+        n_workers = min(self.n_workers or 32, len(core_batches))
+        if n_workers <= 1 or self._executor is None or self._csr is not None:
+            yield from map(self._fetch_expansion, core_batches)
+            return
+        in_flight = deque()
+        for core_batch in core_batches:
+            in_flight.append(self._executor.submit(self._fetch_expansion, core_batch))
+            if len(in_flight) >= 2 * n_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def _build_expansion_query(self) -> str:
         if self.minimum_degree is not None:
-            where_min_degree = f"WHERE u.{self.degree_label} >= {self.minimum_degree}"
-            path_degree_limiter = f' (r, u | u.{self.degree_label} >= {self.minimum_degree})'
+            target_label = f"{self._node_label}:{self.eligible_label}"
         else:
-            where_min_degree = ""
-            path_degree_limiter = ""
-
-        match = f"MATCH p=(c:{self._core_label} {{id:$id_val}})" \
-                f"{self._left_endpoint}[r:{self._rel_label} *{min_hops}..{max_hops}{path_degree_limiter}]{self._right_endpoint}" \
-                f"(:{self._node_label})"
-        with_ = "WITH last(nodes(p)) AS end_node"
-        ret = "RETURN end_node.id AS id"
-
-        if self.weight is not None:
-            with_ = with_ + f", reduce(total_weight=0, n IN relationships(p) | total_weight + n.{self.weight}) AS total_weight "
-            ret = ret + ", total_weight AS path_weight"
-
-            query = ' '.join([match, where_min_degree, with_, ret])
-            node_data = self.database.read(query, id_val=core_id)
+            target_label = self._node_label
+        step_weight = f"r.{self.weight}" if self.weight is not None else "0"
+
+        unwind = "UNWIND $ids AS node_id"
+        match = f"MATCH (n:{self._node_label} {{id:node_id}})" \
+                f"{self._left_endpoint}[r:{self._rel_label}]{self._right_endpoint}" \
+                f"(m:{target_label})"
+        with_ = f"WITH node_id, m.id AS neighbour, max({step_weight}) AS step"
+        ret = "RETURN node_id, neighbour, step"
+        return ' '.join([unwind, match, with_, ret])
+
+    def _fetch_expansion(self, core_ids: List[int]) -> List[Tuple]:
+        frontier = self._frontier
+        node_ids = {node for core in core_ids for node in frontier[core]}
+        if not node_ids:
+            return []
+        if self._csr is not None:
+            neighbours = self._csr_neighbours(node_ids)
         else:
-            query = ' '.join([match, where_min_degree, with_, ret])
-            result = self.database.read(query, id_val=core_id)
-            node_data = [{'id':res['id'], 'path_weight':0} for res in result]
-
-        return node_data
-
-    def _organize_assignments(self, core_id: int, assignments: Dict[int, Dict], nodes_to_organize: List[Dict]) -> Dict[int, Dict]:
-        for node in nodes_to_organize:
-            if node['id'] not in assignments:
-                assignments[node['id']] = {core_id: node['path_weight']}
-            else:
-                assignments[node['id']].update({core_id: node['path_weight']})
-        return assignments
-
-    def _deduplicate_assignments(self, assignments: Dict) -> Dict:
-        return {node: cores for node, cores in assignments.items() if node not in self.final_assignments}
-
-    def _select_closest_core(self, assignments: Dict) -> Dict:
-        return {node: max(cores, key=cores.get) for node, cores in assignments.items()}
-
-    def _reshape_assignments(self, assignments: Dict) -> Dict:
-        return {node: dict(core=core) for node, core in assignments.items()}
-
-    def _add_distance(self, assignments: Dict) -> Dict:
-        for _, data in assignments.items():
-            data.update(dict(distance=self.current_hop))
-        return assignments
+            neighbours = self._fetch_neighbours(node_ids)
+
+        records = []
+        for core in core_ids:
+            reached = {}
+            for node, weight in frontier[core].items():
+                for neighbour, step in neighbours.get(node, ()):
+                    path_weight = weight + step
+                    if neighbour not in reached or path_weight > reached[neighbour]:
+                        reached[neighbour] = path_weight
+            records.extend((core, neighbour, path_weight) for neighbour, path_weight in reached.items())
+        return records
+
+    def _fetch_neighbours(self, node_ids: Set[int]) -> Dict[int, List[Tuple]]:
+        database = self._worker_database()
+        neighbours = {}
+        for id_chunk in chunks(list(node_ids), self.expansion_chunk_size):
+            for record in database.read(self._expansion_query, ids=id_chunk) or []:
+                neighbours.setdefault(record['node_id'], []).append((record['neighbour'], record['step']))
+        return neighbours
+
+    def _load_adjacency(self) -> Tuple:
+        step_weight = f"r.{self.weight}" if self.weight is not None else "0"
+        match = f"MATCH (n:{self._node_label})-[r:{self._rel_label}]->(m:{self._node_label})"
+        ret = f"RETURN n.id AS source, m.id AS target, {step_weight} AS step"
+        result = self.database.read(' '.join([match, ret])) or []
+        sources = [record['source'] for record in result]
+        targets = [record['target'] for record in result]
+        steps = np.asarray([record['step'] for record in result], dtype=np.float64)
+        del result
+
+        if self.orientation == 'in':
+            sources, targets = targets, sources
+        elif self.orientation == 'undirected':
+            sources, targets = sources + targets, targets + sources
+            steps = np.concatenate([steps, steps])
+
+        codes, ids = pd.factorize(pd.Series(sources + targets, dtype=object))
+        n_edges = len(sources)
+        src, dst = codes[:n_edges].astype(np.int32), codes[n_edges:].astype(np.int32)
+        if self.minimum_degree is not None:
+            eligible = self.database.read(f'MATCH (u:{self._node_label}:{self.eligible_label}) RETURN u.id AS id')
+            keep = np.isin(ids[dst], [record['id'] for record in eligible or []])
+            src, dst, steps = src[keep], dst[keep], steps[keep]
+
+        order = np.argsort(src, kind='stable')
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(ids)), out=indptr[1:])
+        index = {node: i for i, node in enumerate(ids)}
+        return index, np.asarray(ids, dtype=object), indptr, dst[order], steps[order].tolist()
+
+    def _csr_neighbours(self, node_ids: Set[int]) -> Dict[int, List[Tuple]]:
+        index, ids, indptr, indices, steps = self._csr
+        neighbours = {}
+        for node in node_ids:
+            i = index.get(node)
+            if i is None:
+                continue
+            start, end = indptr[i], indptr[i + 1]
+            neighbours[node] = list(zip(ids[indices[start:end]].tolist(), steps[start:end]))
+        return neighbours
+
+    def _expand_frontier(self, core_ids: List[int], records: List[Tuple]) -> List[Tuple]:
+        frontier, visited = self._frontier, self._visited
+        for core in core_ids:
+            frontier[core] = {}
+        newly_seen = []
+        for core, node, weight in records:
+            core_visited = visited[core]
+            if node in core_visited:
+                continue
+            core_visited.add(node)
+            frontier[core][node] = weight
+            newly_seen.append((core, node, weight))
+        return newly_seen
+
+    def _find_represented_nodes_batch(self, core_ids: List[int], records: Optional[List[Tuple]]) -> Iterator[Tuple]:
+        if records is not None:
+            return self._expand_frontier(core_ids, records)
+        return ((core, node, weight) for core in core_ids for node, weight in self._frontier[core].items())
+
+    def _organize_assignments(self, nodes_to_organize: Iterator[Tuple]):
+        closest = self._pending
+        assigned = self._assigned
+        if self.tie_break == 'first':
+            for core, node, weight in nodes_to_organize:
+                if node not in assigned:
+                    best = closest.get(node)
+                    if best is None or weight > best[1]:
+                        closest[node] = (core, weight, 1)
+            return
+        for core, node, weight in nodes_to_organize:
+            if node in assigned:
+                continue
+            best = closest.get(node)
+            if best is None or weight > best[1]:
+                closest[node] = (core, weight, 1)
+            elif weight == best[1]:
+                n_tied = best[2] + 1
+                if self._rng.random() * n_tied < 1:
+                    closest[node] = (core, weight, n_tied)
+                else:
+                    closest[node] = (best[0], weight, n_tied)
 
-    def _track_assignments(self, node_ids: List) -> None:
-        self._progress_tracker.update(node_ids)
+    @property
+    def final_assignments(self) -> Dict:
+        cores = self._core_ids[self._assign_core[:self._n]]
+        return {node: dict(core=core, distance=int(distance))
+                for node, core, distance in zip(self._assign_node[:self._n], cores, self._assign_dist[:self._n])}
 
     @property
     def core_label(self):
@@ -307,20 +675,58 @@ class GraphAgglomerator:
         return self._node_label
 
     @property
-    def hop_range(self):
+    def rel_label(self):
+        return self._rel_label
+
+    @property
+    def hop_range(self) -> Tuple[int, int]:
         return self._hops
 
     @property
     def minimum_degree(self):
         return self._minimum_degree
 
+    @property
+    def total_nodes(self) -> int:
+        return self.calculate_graph_size()
+
+    @property
+    def weight(self):
+        return self._weight
+
+    @weight.setter
+    def weight(self, weight: str):
+        self._weight = weight
+        self._rebuild_queries()
+
+    def refresh_cores(self) -> List[int]:
+        result = self.database.read(f'MATCH (c:{self._core_label}) RETURN c.id AS id')
+        self._cores = [r['id'] for r in result or []]
+        self._n_cores = len(self._cores)
+        return self._cores
+
     @property
     def cores(self):
-        return [r['id'] for r in self.database.read(f'MATCH (c:{self._core_label}) RETURN c.id AS id')]
+        if self._cores is None:
+            self.refresh_cores()
+        return self._cores
+
+    @property
+    def n_cores(self) -> int:
+        if self._cores is None:
+            self.refresh_cores()
+        return self._n_cores
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
 
 # TODO add option to choose whether to score by ratio of distinct users, or simply number of distinct users.
 class MetaRelate:
     _knee = None
+    _sorted_scores: Optional[np.ndarray] = None
+    edge_columns = [sys.intern(column) for column in ('source', 'target', 'weight', 'n_distinct', 'score')]
 
     def __init__(self, database: Memgraph, node_label: str, rel_label:str, core_label: str = 'CORE',
                  represents_label: str = 'REPRESENTS', weight:str=None,
@@ -340,15 +746,15 @@ class MetaRelate:
         match_statement = f"MATCH (source:{self.core})-[:{self.represents}]->(n:{self.node})-[r:{self.rel}]->" \
                           f"(:{self.node})<-[:{self.represents}]-(target:{self.core})"
         no_self_loop = "WHERE source <> target"
-        with_distinct = "WITH DISTINCT source, target,"
+        with_group = "WITH source, target,"
         if self.weight is None:
             aggregate_weight = "count(r) AS weight,"
-            set_weight = "mr.weight = weight, "
+            set_weight = "mr.weight = weight"
         else:
             aggregate_weight = f'sum(r.{self.weight}) AS weight, min(r.{self.weight}) AS min_weight, max(r.{self.weight}) AS max_weight,'
             set_weight = "mr.weight = weight, mr.min_weight = min_weight, mr.max_weight = max_weight"
 
-        count_distinct = "count(n) AS n_distinct"
+        count_distinct = "count(DISTINCT n) AS n_distinct"
 
         create_rel = f"MERGE (source)-[mr:{self.meta_rel}]->(target)"
         set_properties = f"ON CREATE SET mr.n_distinct = n_distinct, mr.score = ((n_distinct * 1.0) / source.n_subnodes) * weight, {set_weight}"
@@ -357,7 +763,7 @@ class MetaRelate:
         query = ' '.join([
             match_statement,
             no_self_loop,
-            with_distinct,
+            with_group,
             aggregate_weight,
             count_distinct,
             create_rel,
@@ -369,45 +775,85 @@ class MetaRelate:
     def build_meta_relations(self):
         res = self.db.write(self.query)
         n_created = res[0]['n_rels']
+        self._clear_score_cache()
         return n_created
 
-    def get_meta_rel_weights(self, score_type: str = 'score'):
-        result = self.db.read(f'MATCH ()-[r:{self.meta_rel}]-() WITH DISTINCT r RETURN r.{score_type} AS weight')
-        return [record['weight'] for record in result]
-
-    def score_ecdf(self, markers=True, ecdfnorm=None, **kwargs):
+    def _clear_score_cache(self):
+        self._sorted_scores = None
+        self._knee = None
+
+    def get_sorted_scores(self) -> np.ndarray:
+        if self._sorted_scores is None:
+            self._sorted_scores = np.fromiter(self.get_meta_rel_weights('score', sort=True), dtype=np.float64)
+        return self._sorted_scores
+
+    def get_meta_rel_weights(self, score_type: str = 'score', sort: bool = False):
+        query = f'MATCH ()-[r:{self.meta_rel}]->() RETURN r.{score_type} AS weight'
+        if sort:
+            query = query + ' ORDER BY weight'
+        result = self.db.read(query)
+        return [record['weight'] for record in result or []]
+
+    def get_meta_rel_histogram(self, score_type: str = 'score', decimals: int = 2) -> List[Dict]:
+        factor = 10 ** decimals
+        result = self.db.read(f'MATCH ()-[r:{self.meta_rel}]->() '
+                              f'WITH round(r.{score_type} * {factor}) / {factor} AS bucket '
+                              f'RETURN bucket, count(*) AS freq ORDER BY bucket')
+        return result or []
+
+    def score_ecdf(self, markers=True, ecdfnorm=None, bin_decimals: int = None, **kwargs):
         knee = self.cutoff_score
-        weights = sorted(self.get_meta_rel_weights(score_type='score'))
+        title = f'Weight ECDF: {self.meta_rel.title()}'
 
-        fig = px.ecdf(x=weights, title=f'Weight ECDF: {self.meta_rel.title()}',
-                      ecdfnorm=ecdfnorm, labels=dict(x='score'), markers=markers, **kwargs)
+        if bin_decimals is None:
+            weights = self.get_sorted_scores()
+            fig = px.ecdf(x=weights, title=title,
+                          ecdfnorm=ecdfnorm, labels=dict(x='score'), markers=markers, **kwargs)
+            y_point = int(np.searchsorted(weights, knee, side='right'))
+        else:
+            histogram = self.get_meta_rel_histogram(score_type='score', decimals=bin_decimals)
+            buckets = [record['bucket'] for record in histogram]
+            counts = [record['freq'] for record in histogram]
+            fig = px.ecdf(x=buckets, y=counts, title=title,
+                          ecdfnorm=ecdfnorm, labels=dict(x='score'), markers=markers, **kwargs)
+            y_point = sum(count for bucket, count in zip(buckets, counts) if bucket <= knee)
 
-        y_point = len(weights) - weights[::-1].index(knee)
         fig.add_hline(y=y_point, fillcolor='green')
 
         return fig
 
     def calculate_cutoff_score(self, online=True, **kwargs):
-        sorted_weights = sorted(self.get_meta_rel_weights('score'))
+        sorted_weights = self.get_sorted_scores()
         kneedle = KneeLocator(range(len(sorted_weights)), sorted_weights,online=online, direction='increasing', curve='convex', **kwargs)
         self._knee = kneedle.knee_y
         return float(self._knee)
 
     def reset(self):
         self.db.write(f'MATCH ()-[r:{self.meta_rel}]-() DELETE r')
+        self._clear_score_cache()
 
-    def get_core_edge_list(self, unfiltered: bool = False) -> List[Dict]:
+    def iter_core_edges(self, unfiltered: bool = False, page_size: int = 10000) -> Iterator[Dict]:
         if not self.count_meta_relations() > 0:
             raise Exception(f'No meta_relations of type {self.meta_rel} detected. Please .build_meta_relations() first.')
         match_query = f'MATCH (source:{self.core})-[r:{self.meta_rel}]->(target:{self.core})'
         where_query = 'WHERE r.score >= $cutoff'
-        return_query = "RETURN source.id AS source, target.id AS target, r.weight AS weight, r.n_distinct AS n_distinct, r.score AS score"
+        return_query = "RETURN source.id AS source, target.id AS target, r.weight AS weight, " \
+                       "r.n_distinct AS n_distinct, r.score AS score"
         query_sequence = [match_query, where_query, return_query]
         if unfiltered:
             query_sequence.pop(1)
         query = ' '.join(query_sequence)
-        result = self.db.read(query, cutoff=self.cutoff_score)
-        return result
+        cutoff = None if unfiltered else self.cutoff_score
+        for record in iter_read(self.db, query, page_size=page_size, cutoff=cutoff):
+            yield {column: _intern(record[column]) for column in self.edge_columns}
+
+    def get_core_edge_list(self, unfiltered: bool = False, page_size: int = 10000) -> List[Dict]:
+        result = list(self.iter_core_edges(unfiltered=unfiltered, page_size=page_size))
+        return result or None
+
+    def get_core_edge_frame(self, unfiltered: bool = False, page_size: int = 10000) -> pd.DataFrame:
+        return pd.DataFrame.from_records(self.iter_core_edges(unfiltered=unfiltered, page_size=page_size),
+                                         columns=self.edge_columns)
 
     def get_core_node_list(self, unfiltered: bool = False) -> List[Dict]:
         if not self.count_meta_relations() > 0:
@@ -424,9 +870,9 @@ class MetaRelate:
 
 
     def count_meta_relations(self) -> int:
-        return self.db.read(f'MATCH ()-[r:{self.meta_rel}]->() RETURN count(r) AS n_rels')[0]['n_rels']
+        return read_scalar(self.db, f'MATCH ()-[r:{self.meta_rel}]->() RETURN count(r) AS n_rels', 'n_rels', default=0)
 
-    @property
+    @cached_property
     def query(self):
         return self._build_query()
 
@@ -1,13 +1,17 @@
+import numpy as np
 from tqdm.auto import tqdm
 
 from mini_memgraph import Memgraph
+from mini_memgraph.utility import chunks
 from squashy.metrics import DecomposerMetrics
+from squashy.utility import read_scalar
 
 #TODO catch if graph is about to run out of nodes. elegantly end decomposition
 class KCoreIdentifier:
     def __init__(self, database: Memgraph, node_label: str, rel_label: str, core_label: str = 'CORE',
                  target_label: str = None, metrics_path=None, k: int = 2, max_cores: int = 500,
-                 filter_attr: str = 'decomposed', degree_attr: str = 'decomp_degree', orientation='undirected'):
+                 filter_attr: str = 'decomposed', degree_attr: str = 'decomp_degree', orientation='undirected',
+                 in_memory: bool = False):
 
         self.database = database
         self.k = k
@@ -17,6 +21,7 @@ class KCoreIdentifier:
         self.calc_degree_label = 'calc_degree'
         self.degree_label = degree_attr
         self.orientation = orientation
+        self.in_memory = in_memory
 
         self.node_label = node_label
         self.rel_label = rel_label
@@ -36,15 +41,22 @@ class KCoreIdentifier:
         if not self.database.node_count(self.core_label) == 0:
             raise Exception(f'Error - Label {self.core_label} still present after reset.')
 
+    def has_cores(self) -> bool:
+        return read_scalar(self.database, f'MATCH (n:{self.core_label}) RETURN n.id AS id LIMIT 1', 'id') is not None
+
+    @property
+    def _reset_properties(self):
+        return [self.filter_attr, self.degree_label, self.calc_degree_label]
+
     def reset_assignments(self):
-        for label in (self.filter_attr, self.degree_label, self.calc_degree_label):
+        for label in self._reset_properties:
             self.database.remove_node_attr(self.node_label, label)
             if not self.database.node_count(self.node_label, where=f'WHERE n.{label} IS NOT NULL') == 0:
                 raise Exception(f'Error - Filter attribute {label} still present after reset.')
 
     def reset(self):
-        self.reset_assignments()
-        self.reset_cores()
+        remove_attrs = ', '.join(f'n.{attr}' for attr in self._reset_properties)
+        self.database.write(f'MATCH (n:{self.node_label}) REMOVE {remove_attrs}, n:{self.core_label}')
         self.metrics = self.metrics.reset_metrics()
         self.metrics.graph_size = self._graph_size
 
@@ -106,9 +118,11 @@ class KCoreIdentifier:
                                      target_label=self.target_label,set_property=self.calc_degree_label,
                                      orientation=self.orientation)
         avg_degree_query = f'MATCH (n:{self.node_label}) RETURN avg(n.{self.calc_degree_label}) AS avg_degree'
-        return self.database.read(avg_degree_query)[0]['avg_degree']
+        return read_scalar(self.database, avg_degree_query, 'avg_degree')
 
     def identify_core_nodes(self):
+        if self.in_memory:
+            return self._identify_core_nodes_in_memory()
 
         self._run_decomposition_pass()
 
@@ -143,3 +157,130 @@ class KCoreIdentifier:
                 self.metrics.new_record()
 
         self.metrics.report('Finished')
+
+    def _load_graph(self):
+        node_query = f'MATCH (n:{self.node_label}) ' \
+                     f'RETURN n.id AS id, n.{self.filter_attr} AS decomposed, n.{self.degree_label} AS degree'
+        nodes = self.database.read(node_query) or []
+        self._ids = [record['id'] for record in nodes]
+        self._index = {node: i for i, node in enumerate(self._ids)}
+        self._alive = np.array([record['decomposed'] is None for record in nodes], dtype=bool)
+        self._degree = np.array([np.nan if record['degree'] is None else record['degree'] for record in nodes],
+                                dtype=np.float64)
+        self._initial_alive = self._alive.copy()
+        self._initial_degree = self._degree.copy()
+        self._new_cores = []
+        del nodes
+
+        rel = f'-[r:{self.rel_label}]-' if self.rel_label is not None else '-[r]-'
+        if self.orientation.lower() == 'in':
+            rel = '<' + rel
+        elif self.orientation.lower() == 'out':
+            rel = rel + '>'
+        target_label = self.node_label if self.target_label is None else self.target_label
+        edges = self.database.read(f'MATCH (s:{self.node_label}){rel}(t:{target_label}) '
+                                   f'RETURN s.id AS source, t.id AS target') or []
+        n_nodes = len(self._ids)
+        source = np.fromiter((self._index[record['source']] for record in edges), dtype=np.int64, count=len(edges))
+        target = np.fromiter((self._index.get(record['target'], -1) for record in edges), dtype=np.int64,
+                             count=len(edges))
+        del edges
+
+        target_alive = np.where(target >= 0, self._alive[np.maximum(target, 0)], True)
+        self._live_degree = np.bincount(source[target_alive], minlength=n_nodes)
+        tracked = target >= 0
+        source, target = source[tracked], target[tracked]
+        order = np.argsort(target, kind='stable')
+        self._rev_indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(target, minlength=n_nodes), out=self._rev_indptr[1:])
+        self._rev_indices = source[order]
+
+    def _remove_nodes(self, nodes: np.ndarray):
+        self._alive[nodes] = False
+        starts, ends = self._rev_indptr[nodes], self._rev_indptr[nodes + 1]
+        lengths = ends - starts
+        if lengths.sum() == 0:
+            return
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        sources = self._rev_indices[offsets + np.arange(lengths.sum())]
+        self._live_degree -= np.bincount(sources, minlength=len(self._live_degree))
+
+    def _run_decomposition_pass_in_memory(self):
+        updated = self._alive & (self._live_degree > 0)
+        self._degree[updated] = self._live_degree[updated]
+        remaining = self._degree[self._alive]
+        remaining = remaining[~np.isnan(remaining)]
+        self.metrics.n_remaining = int(self._alive.sum())
+        self.metrics.min_degree = int(remaining.min()) if len(remaining) > 0 else 0
+        self.metrics.max_degree = int(remaining.max()) if len(remaining) > 0 else 0
+
+    def _prune_in_memory(self) -> int:
+        pruned = np.flatnonzero(self._alive & (self._degree < self.k))
+        self._remove_nodes(pruned)
+        return len(pruned)
+
+    def _register_core_in_memory(self):
+        candidates = np.flatnonzero(self._alive & (self._degree == self.metrics.max_degree))
+        if len(candidates) > 0:
+            new_core = candidates[:1]
+            self._remove_nodes(new_core)
+            self._new_cores.append(self._ids[new_core[0]])
+        self.metrics.cores_identified += 1
+
+    def _write_graph(self, chunk_size: int = 10000):
+        changed = np.flatnonzero((self._alive != self._initial_alive) |
+                                 ~((self._degree == self._initial_degree) |
+                                   (np.isnan(self._degree) & np.isnan(self._initial_degree))))
+        rows = [{'id': self._ids[i],
+                 'decomposed': None if self._alive[i] else True,
+                 'degree': None if np.isnan(self._degree[i]) else int(self._degree[i])}
+                for i in changed.tolist()]
+        node_query = f'UNWIND $rows AS row MATCH (n:{self.node_label} {{id: row.id}}) ' \
+                     f'SET n.{self.filter_attr} = row.decomposed, n.{self.degree_label} = row.degree'
+        for row_chunk in chunks(rows, chunk_size):
+            self.database.write(node_query, rows=row_chunk)
+        core_query = f'UNWIND $ids AS node_id MATCH (n:{self.node_label} {{id: node_id}}) ' \
+                     f'SET n:{self.node_label}:{self.core_label}'
+        for id_chunk in chunks(self._new_cores, chunk_size):
+            self.database.write(core_query, ids=id_chunk)
+
+    def _release_graph(self):
+        for attr in ('_ids', '_index', '_alive', '_degree', '_live_degree', '_initial_alive', '_initial_degree',
+                     '_new_cores', '_rev_indptr', '_rev_indices'):
+            self.__dict__.pop(attr, None)
+
+    def _identify_core_nodes_in_memory(self):
+        self._load_graph()
+        try:
+            self._run_decomposition_pass_in_memory()
+
+            with tqdm(total=self.max_cores, desc=self.metrics.report()) as bar:
+                bar.update(self.metrics.cores_identified)
+                while (self.metrics.min_degree < self.k) and \
+                        (self.metrics.cores_identified < self.max_cores) and \
+                        self.metrics.n_remaining > 0:
+                    self.metrics.start_timer()
+                    n_pruned = self._prune_in_memory()
+                    if self.metrics.n_remaining < 1:
+                        break
+
+                    self._run_decomposition_pass_in_memory()
+                    bar.set_description(self.metrics.report())
+                    if n_pruned == 0 and self.metrics.min_degree < self.k:
+                        break
+
+                    while (self.metrics.min_degree >= self.k) and (self.metrics.cores_identified < self.max_cores):
+                        self._register_core_in_memory()
+                        self._run_decomposition_pass_in_memory()
+                        bar.update(1)
+                        bar.set_description(self.metrics.report())
+
+                    self.metrics.stop_timer()
+                    self.metrics.new_record()
+        finally:
+            try:
+                self._write_graph()
+            finally:
+                self._release_graph()
+
+        self.metrics.report('Finished')
@@ -1,11 +1,23 @@
-from typing import List, Tuple
+import sqlite3
+from functools import lru_cache
+from itertools import chain
+from typing import List, Tuple, Iterable, Iterator, Dict, Optional
 
+import pandas as pd
 from mini_memgraph import Memgraph
+from mini_memgraph.utility import chunks
+from squashy.utility import read_scalar
+
+
+@lru_cache(maxsize=16)
+def _is_valid_label(label: str) -> bool:
+    return label.isupper()
 
 
 class DataImporter:
     node_label: str
     edge_label: str
+    chunk_size = 100000
 
     def __init__(self, database: Memgraph = None, node_label='NODE', edge_label='REL', weight_label: str = None,
                  address: str = 'locahost', port: int = 7687, wipe_db: bool = False):
@@ -35,38 +47,39 @@ class DataImporter:
         self.db.write('MATCH (n) DETACH DELETE n')
 
 
-    def _prep_node_list(self, nodes: List):
-        return [{'id': n} for n in nodes]
+    def _prep_node_list(self, nodes: Iterable) -> Iterator[Dict]:
+        return ({'id': n} for n in nodes)
 
-    def _prep_edge_list(self, edges: List):
-        if self.weight_label is not None:
-            prepped = [{'source': record[0],
-                        'target': record[1],
-                        self.weight_label: record[2]} for record in edges]
-        else:
-            prepped = [{'source': record[0],
-                        'target': record[1]} for record in edges]
-        return prepped
+    def _prep_edge_list(self, edges: Iterable[Tuple]) -> Iterator[Dict]:
+        weight_label = self.weight_label
+        if weight_label is not None:
+            return ({'source': source, 'target': target, weight_label: weight} for source, target, weight in edges)
+        return ({'source': source, 'target': target} for source, target, *_ in edges)
 
     def load_nodes(self, node_list: List):
         if not isinstance(node_list, list):
             raise TypeError('node_list must be a list of node ids')
-        if len(node_list) > len(set(node_list)):
+        if not pd.Series(node_list).is_unique:
             raise ValueError('All ids in the node list must be unique')
-        data = self._prep_node_list(node_list)
-        self.db.write_nodes(data, label=self.node_label, id_val='id')
+        self._write_nodes(node_list)
+
+    def _write_nodes(self, node_list: List):
+        for node_chunk in chunks(node_list, self.chunk_size):
+            data = list(self._prep_node_list(node_chunk))
+            self.db.write_nodes(data, label=self.node_label, id_val='id', chunk_size=self.chunk_size)
 
     def load_edges(self, edge_list: List[Tuple]):
         if not isinstance(edge_list, list) or not isinstance(edge_list[0], tuple) or not len(edge_list[0]) > 1:
             raise TypeError('edge_list must be a list of Tuples of len 2 or 3 if including weight')
-        data = self._prep_edge_list(edge_list)
-        self.db.write_edges(data, source_label=self.node_label, edge_label=self.edge_label,
-                            target_label=self.node_label,
-                            on_duplicate_edges='increment', add_attributes=[self.weight_label],
-                            source_id_label='id', target_id_label='id')
+        for edge_chunk in chunks(edge_list, self.chunk_size):
+            data = list(self._prep_edge_list(edge_chunk))
+            self.db.write_edges(data, source_label=self.node_label, edge_label=self.edge_label,
+                                target_label=self.node_label,
+                                on_duplicate_edges='increment', add_attributes=[self.weight_label],
+                                source_id_label='id', target_id_label='id', chunk_size=self.chunk_size)
 
     def check_label(self, label: str):
-        if not label.isupper():
+        if not _is_valid_label(label):
             raise Exception(f'Node or edge labels should be UPPERCASE. {label=}')
         return label
 
@@ -75,16 +88,45 @@ class DataImporter:
 
 
     def load_from_edge_list(self, edge_tuples: List[Tuple]):
-        node_list = set()
-        node_list.update([record[0] for record in edge_tuples])
-        node_list.update([record[1] for record in edge_tuples])
-        node_list = list(node_list)
-        self.load_nodes(node_list)
+        node_ids = pd.Series(chain.from_iterable((source, target) for source, target, *_ in edge_tuples))
+        self._write_nodes(node_ids.unique().tolist())
         self.load_edges(edge_tuples)
 
     def report(self):
         n_nodes = self.db.node_count(self.node_label)
-        n_rels = self.db.read(f'MATCH ()-[r:{self.edge_label}]-() WITH DISTINCT r RETURN count(r) AS n_rels')[0][
-            'n_rels']
+        n_rels = read_scalar(self.db, f'MATCH ()-[r:{self.edge_label}]->() RETURN count(r) AS n_rels', 'n_rels', default=0)
         return f"Database currently has {n_nodes:,} {self.node_label} nodes, and {n_rels:,} {self.edge_label} edges."
 
+
+class AssignmentCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS assignments (node PRIMARY KEY, core, distance INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS run (id INTEGER PRIMARY KEY CHECK (id = 0), key TEXT)')
+        self.connection.commit()
+
+    def append(self, rows: Iterable[Tuple]):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?)', rows)
+
+    def drop_from_distance(self, distance: int):
+        with self.connection:
+            self.connection.execute('DELETE FROM assignments WHERE distance >= ?', (distance,))
+
+    def clear(self, run_key: str = None):
+        with self.connection:
+            self.connection.execute('DELETE FROM assignments')
+            self.connection.execute('INSERT OR REPLACE INTO run VALUES (0, ?)', (run_key,))
+
+    @property
+    def run_key(self) -> Optional[str]:
+        row = self.connection.execute('SELECT key FROM run WHERE id = 0').fetchone()
+        return None if row is None else row[0]
+
+    def count(self) -> int:
+        return self.connection.execute('SELECT count(*) FROM assignments').fetchone()[0]
+
+    def load(self) -> List[Tuple]:
+        return self.connection.execute('SELECT node, core, distance FROM assignments').fetchall()
@@ -1,7 +1,13 @@
-from mini_memgraph import Memgraph
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, List, Dict, Iterator
+
+import pandas as pd
 
 from squashy.agglomeration import GraphAgglomerator, MetaRelate
 from squashy.decomposition import KCoreIdentifier
+from squashy.utility import SessionMemgraph, read_scalar
 
 
 class Squash:
@@ -20,29 +26,57 @@ class Squash:
         The GraphAgglomerator used in the compression process. Use to access metrics and associated attributes.
     meta_relator : MetaRelate
         The MetaRelate class used in the compression process. Use to access metrics and associated attributes.
+    last_run_stats : dict
+        Wall time in seconds of each stage of the last squash_graph call, and whether it was skipped.
 
     Methods
     ----------
-    squash_graph(max_cores=500, k=2, min_hops=None, max_hops=None)
+    squash_graph(max_cores=500, k=2, min_hops=None, max_hops=None, pipelined=True)
         Generates the compressed core graph. Steps through each stage of core identification,
          assignment of representatives and the generation of meta-relations.
+         When pipelined, the agglomerator's graph size is counted while cores are being identified.
+         Returns early if the parameters and graph size match the previous completed run.
+         Per-stage wall times in seconds are recorded on last_run_stats.
+         Core identification is skipped when only the hop range changed since the previous run.
 
-    get_core_edge_list()
+    get_core_edge_list(page_size=10000)
         Returns a list of dictionary edges of format {source, target, **weight values}.
+        Edges are fetched from a single streamed query page_size rows at a time.
         Equivalent to MetaRelate.get_core_edge_list()
 
+    iter_core_edges(page_size=10000)
+        Yields the same dictionary edges page by page without holding the full edge list in memory.
+        Equivalent to MetaRelate.iter_core_edges()
+
+    get_core_edge_frame(page_size=10000)
+        Returns the core edges as a DataFrame with columns source, target, weight, n_distinct and score.
+
     get_core_node_list()
         Returns a list of dictionary node records of format {id, n_subnodes}
         where n_subnodes is the number of node_label nodes represented by each core node.
         Equivalent to MetaRelate.get_core_node_list()
+
+    to_networkit(weight='score', directed=True)
+        Returns the core graph as a networkit.Graph along with the list of core ids,
+        where node i of the graph is core id i of the list. Requires networkit.
+
+    to_igraph(directed=True)
+        Returns the core graph as an igraph.Graph with core ids stored as the vertex name
+        and weight, n_distinct and score stored as edge attributes. Requires python-igraph.
     reset()
         Wipes all core graph metrics and assignments from the database ready to re-run compression.
+    close()
+        Closes the database connection. Squash can also be used as a context manager.
 
     """
 
     decomposer: KCoreIdentifier
     agglomerator: GraphAgglomerator
     meta_relator: MetaRelate
+    _edge_cache: Optional[Tuple[float, Optional[List[Dict]]]] = None
+    _node_cache: Optional[Tuple[float, Optional[List[Dict]]]] = None
+    last_run_stats: Dict
+    _last_decompose_params: Optional[Tuple] = None
 
     def __init__(self, node_label: str, relation_label: str, weight_label: str = None, db_address: str = 'localhost',
                  db_port: int = 7687, decomposer: KCoreIdentifier = None,
@@ -69,7 +103,8 @@ class Squash:
             To use non-default settings pass in a custom instance of MetaRelate.
         """
 
-        self.db = Memgraph(address=db_address, port=db_port)
+        self.db = SessionMemgraph(address=db_address, port=db_port)
+        self.last_run_stats = {}
 
         self.decomposer = decomposer
         self.agglomerator = agglomerator
@@ -84,25 +119,139 @@ class Squash:
         if self.meta_relator is None:
             self.meta_relator = MetaRelate(self.db, node_label, relation_label,
                                            weight=weight_label)
+        self._ensure_indexes(node_label)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _ensure_indexes(self, node_label: str):
+        self.db.set_index(node_label)
+        self.db.set_index(node_label, 'id')
+        self.db.set_index(node_label, self.decomposer.degree_label)
 
     def reset(self):
         self.meta_relator.reset()
         self.agglomerator.reset()
         self.decomposer.reset()
+        self.db.write('MATCH (n:META:SQUASH) DELETE n')
+        self._last_decompose_params = None
+        self._clear_list_cache()
 
-    def squash_graph(self, max_cores: int = 500, k: int = 2, min_hops: int = None, max_hops: int = None):
+    def _clear_list_cache(self):
+        self._edge_cache = None
+        self._node_cache = None
+
+    def squash_graph(self, max_cores: int = 500, k: int = 2, min_hops: int = None, max_hops: int = None,
+                     pipelined: bool = True):
         self.decomposer.max_cores = max_cores
         self.decomposer.k = k
-        if min_hops is not None:
-            self.agglomerator.set_minimum_hop(min_hops)
-        if max_hops is not None:
-            self.agglomerator.set_maximum_hop(max_hops)
-        self.decomposer.identify_core_nodes()
+        if min_hops is not None or max_hops is not None:
+            current_min, current_max = self.agglomerator.hop_range
+            self.agglomerator.set_hop_range(min_hops=current_min if min_hops is None else min_hops,
+                                            max_hops=current_max if max_hops is None else max_hops)
+        start = time.perf_counter()
+        self.last_run_stats = {'skipped': False}
+        signature = self._current_signature()
+        if signature == self._stored_signature() and self.agglomerator.has_assignments() and \
+                self.meta_relator.count_meta_relations() > 0:
+            self.last_run_stats.update(skipped=True, total_s=time.perf_counter() - start)
+            return
+        stage_start = time.perf_counter()
+        decompose_params = (k, max_cores, self.decomposer.node_label, self.decomposer.rel_label)
+        if decompose_params == self._last_decompose_params and self.decomposer.has_cores():
+            self.last_run_stats['decompose_skipped'] = True
+        elif pipelined:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                graph_size = executor.submit(self.agglomerator.calculate_graph_size)
+                self.decomposer.identify_core_nodes()
+                graph_size.result()
+        else:
+            self.decomposer.identify_core_nodes()
+        self._last_decompose_params = decompose_params
+        self.last_run_stats['decompose_s'] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
         self.agglomerator.agglomerate()
+        self.last_run_stats['agglomerate_s'] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
         self.meta_relator.build_meta_relations()
+        self.last_run_stats['meta_relate_s'] = time.perf_counter() - stage_start
+        self.db.write('MERGE (n:META:SQUASH) SET n.signature = $signature', signature=signature)
+        self._clear_list_cache()
+        self.last_run_stats['total_s'] = time.perf_counter() - start
+
+    def _current_signature(self) -> str:
+        node_label = self.decomposer.node_label
+        rel_label = self.decomposer.rel_label
+        n_nodes = read_scalar(self.db, f'MATCH (n:{node_label}) RETURN count(n) AS n_nodes', 'n_nodes', default=0)
+        n_rels = read_scalar(self.db, f'MATCH ()-[r:{rel_label}]->() RETURN count(r) AS n_rels', 'n_rels', default=0)
+        decomposer, agglomerator, meta_relator = self.decomposer, self.agglomerator, self.meta_relator
+        params = (
+            (node_label, rel_label, n_nodes, n_rels),
+            (decomposer.k, decomposer.max_cores, decomposer.core_label, decomposer.target_label,
+             decomposer.orientation, decomposer.filter_attr, decomposer.degree_label, decomposer.in_memory),
+            (agglomerator.node_label, agglomerator.rel_label, agglomerator.core_label, agglomerator.weight,
+             agglomerator.orientation, agglomerator.minimum_degree, agglomerator.hop_range,
+             agglomerator.tie_break, agglomerator.seed, agglomerator.in_memory),
+            (meta_relator.node, meta_relator.rel, meta_relator.core, meta_relator.represents, meta_relator.weight,
+             meta_relator.orientation),
+        )
+        return hashlib.blake2b(repr(params).encode(), digest_size=16).hexdigest()
+
+    def _stored_signature(self) -> Optional[str]:
+        return read_scalar(self.db, 'MATCH (n:META:SQUASH) RETURN n.signature AS signature', 'signature')
+
+    def get_core_edge_list(self, page_size: int = 10000):
+        if self._edge_cache is None or self._edge_cache[0] != self.meta_relator.cutoff_score:
+            edges = self.meta_relator.get_core_edge_list(page_size=page_size)
+            self._edge_cache = (self.meta_relator.cutoff_score, edges)
+        return None if self._edge_cache[1] is None else [dict(edge) for edge in self._edge_cache[1]]
 
-    def get_core_edge_list(self):
-        return self.meta_relator.get_core_edge_list()
+    def iter_core_edges(self, page_size: int = 10000) -> Iterator[Dict]:
+        if self._edge_cache is not None and self._edge_cache[0] == self.meta_relator.cutoff_score:
+            yield from (dict(edge) for edge in self._edge_cache[1] or [])
+        else:
+            yield from self.meta_relator.iter_core_edges(page_size=page_size)
+
+    def get_core_edge_frame(self, page_size: int = 10000):
+        return pd.DataFrame(self.get_core_edge_list(page_size=page_size) or [], columns=self.meta_relator.edge_columns)
 
     def get_core_node_list(self):
-        return self.meta_relator.get_core_node_list()
+        if self._node_cache is None or self._node_cache[0] != self.meta_relator.cutoff_score:
+            nodes = self.meta_relator.get_core_node_list()
+            self._node_cache = (self.meta_relator.cutoff_score, nodes)
+        return None if self._node_cache[1] is None else [dict(node) for node in self._node_cache[1]]
+
+    def _core_node_index(self) -> Dict:
+        return {record['id']: i for i, record in enumerate(self.get_core_node_list() or [])}
+
+    def to_networkit(self, weight: str = 'score', directed: bool = True):
+        try:
+            import networkit as nk
+        except ImportError:
+            raise ImportError('to_networkit requires networkit. Install it with `pip install networkit`.')
+        node_index = self._core_node_index()
+        graph = nk.Graph(len(node_index), weighted=True, directed=directed)
+        for edge in self.iter_core_edges():
+            graph.addEdge(node_index[edge['source']], node_index[edge['target']], edge[weight])
+        return graph, list(node_index)
+
+    def to_igraph(self, directed: bool = True):
+        try:
+            import igraph as ig
+        except ImportError:
+            raise ImportError('to_igraph requires python-igraph. Install it with `pip install igraph`.')
+        nodes = self.get_core_node_list() or []
+        node_index = {record['id']: i for i, record in enumerate(nodes)}
+        edge_frame = self.get_core_edge_frame()
+        edges = list(zip(edge_frame['source'].map(node_index).tolist(), edge_frame['target'].map(node_index).tolist()))
+        edge_attrs = {column: edge_frame[column].tolist() for column in self.meta_relator.edge_columns[2:]}
+        vertex_attrs = {'name': [record['id'] for record in nodes],
+                        'n_subnodes': [record['n_subnodes'] for record in nodes]}
+        return ig.Graph(n=len(nodes), edges=edges, directed=directed,
+                        vertex_attrs=vertex_attrs, edge_attrs=edge_attrs)
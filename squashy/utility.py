@@ -0,0 +1,70 @@
+from typing import Any, Dict, Iterator
+
+import mgclient
+from mini_memgraph import Memgraph
+
+
+def read_scalar(database: Memgraph, query: str, key: str, default: Any = None, **kwargs) -> Any:
+    result = database.read(query, **kwargs)
+    if not result:
+        return default
+    return result[0][key]
+
+
+def iter_read(database: Memgraph, query: str, page_size: int = 10000, **kwargs) -> Iterator[Dict]:
+    connection = mgclient.connect(host=database._address, port=database._port,
+                                  username='' if database._user is None else database._user,
+                                  password='' if database._password is None else database._password,
+                                  lazy=True)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(query, kwargs)
+        labels = Memgraph._get_return_labels(query)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield from Memgraph._label_results(Memgraph._unpack_results(rows), labels)
+    finally:
+        connection.close()
+
+
+class SessionMemgraph(Memgraph):
+    def _connect(self):
+        if not self.connected:
+            super()._connect()
+
+    def _disconnect(self):
+        pass
+
+    def close(self):
+        try:
+            super()._disconnect()
+        finally:
+            self.connected = False
+
+    def read(self, query: str, **kwargs):
+        try:
+            return super().read(query, **kwargs)
+        except BaseException:
+            self.close()
+            raise
+
+    def write(self, query: str, commit=True, **kwargs):
+        try:
+            return super().write(query, commit=commit, **kwargs)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __copy__(self):
+        return type(self)(self._address, self._port, self._user, self._password)
+
+    def __del__(self):
+        self.close()
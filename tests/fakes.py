@@ -0,0 +1,145 @@
+import re
+from typing import Dict, List, Set
+
+
+class FakeMemgraph:
+    """In-memory stand-in for mini_memgraph.Memgraph answering the queries issued by the agglomerator."""
+
+    def __init__(self, edges: List[tuple], cores: List[int]):
+        self.adjacency: Dict[int, Set[int]] = {}
+        for source, target in edges:
+            self.adjacency.setdefault(source, set()).add(target)
+            self.adjacency.setdefault(target, set()).add(source)
+        self.cores = list(cores)
+        self.rels = {}
+        self.meta = {}
+        self.labels: Dict[str, Set[int]] = {}
+        self.signature = None
+
+    def label_exists(self, label: str) -> bool:
+        return True
+
+    def attr_exists(self, *args, **kwargs) -> bool:
+        return False
+
+    def set_degree(self, *args, **kwargs) -> int:
+        return 0
+
+    def set_index(self, *args, **kwargs):
+        pass
+
+    def node_count(self, *args, **kwargs) -> int:
+        return len(self.adjacency)
+
+    def remove_node_label(self, remove_label: str, ids=None):
+        self.labels.pop(remove_label, None)
+
+    def wipe_relationships(self, *args):
+        self.rels = {}
+
+    def _disconnect(self):
+        pass
+
+    def write(self, query: str, **kwargs):
+        if 'UNWIND $rows' in query and 'REPRESENTS' in query:
+            for row in kwargs['rows']:
+                self.rels[row['target']] = (row['source'], row['distance'])
+        elif query.startswith('CREATE (n:META:'):
+            label = query.split(':')[2].split(')')[0]
+            self.meta.setdefault(label, []).append(dict(kwargs['data_attr']))
+        elif query.startswith('MATCH (n:META:') and 'DELETE' in query:
+            label = query.split(':')[2].split(')')[0]
+            if 'max_hop_val' in kwargs:
+                self.meta[label] = [r for r in self.meta.get(label, []) if r['hop'] < kwargs['max_hop_val']]
+            else:
+                self.meta.pop(label, None)
+        elif 'REPRESENTS' in query and 'DELETE' in query:
+            self.rels = {n: (c, d) for n, (c, d) in self.rels.items() if d < kwargs['max_hop_val']}
+        elif 'META:SQUASH' in query and 'signature' in kwargs:
+            self.signature = kwargs['signature']
+        elif 'SET u:' in query:
+            label = query.split('SET u:')[1].strip()
+            degree = kwargs['min_degree']
+            self.labels[label] = {n for n, neighbours in self.adjacency.items() if len(neighbours) >= degree}
+
+    def read(self, query: str, **kwargs):
+        if re.search(r'MATCH \(c:CORE\) RETURN c.id AS id', query):
+            return [{'id': core} for core in self.cores] or None
+        if 'META:SQUASH' in query:
+            return [{'signature': self.signature}] if self.signature is not None else None
+        if query.startswith('MATCH (n:META:'):
+            label = query.split(':')[2].split(')')[0]
+            return [dict(record) for record in self.meta.get(label, [])] or None
+        if 'n_done = $n_cores' in query:
+            done = {}
+            for record in self.meta.get('AGGLOM', []):
+                done[record['hop']] = max(done.get(record['hop'], 0), record['n_cores'])
+            return [{'hop': hop} for hop, n_done in done.items() if n_done == kwargs['n_cores']] or None
+        if 'UNWIND $ids AS node_id' in query:
+            eligible = self._eligible(query)
+            rows = [{'node_id': node, 'neighbour': neighbour, 'step': 0}
+                    for node in kwargs['ids'] for neighbour in self.adjacency.get(node, ())
+                    if neighbour in eligible]
+            return rows or None
+        if 'RETURN n.id AS source, m.id AS target' in query:
+            eligible = self._eligible(query)
+            return [{'source': source, 'target': target, 'step': 0}
+                    for source, neighbours in self.adjacency.items() for target in neighbours
+                    if target in eligible] or None
+        if 'count(u) AS n_nodes' in query:
+            return [{'n_nodes': sum(1 for neighbours in self.adjacency.values() if neighbours)}]
+        if 'RETURN count(r) AS n_rels' in query and 'REPRESENTS' in query:
+            return [{'n_rels': len(self.rels)}]
+        if 'RETURN id(r) AS id LIMIT 1' in query and 'REPRESENTS' in query:
+            return [{'id': 0}] if self.rels else None
+        if 'RETURN c.id AS core, n.id AS node' in query:
+            return [{'core': c, 'node': n, 'distance': d} for n, (c, d) in self.rels.items()] or None
+        if 'WITH DISTINCT c RETURN c.id AS id' in query:
+            eligible = self._eligible(query)
+            return [{'id': core} for core in self.cores if self.adjacency.get(core, set()) & eligible] or None
+        if 'RETURN count(n) AS n_nodes' in query:
+            return [{'n_nodes': len(self.adjacency)}]
+        if 'RETURN count(r) AS n_rels' in query:
+            return [{'n_rels': sum(len(neighbours) for neighbours in self.adjacency.values()) // 2}]
+        raise NotImplementedError(query)
+
+    def _eligible(self, query: str) -> Set:
+        for label, nodes in self.labels.items():
+            if f':{label}' in query:
+                return nodes
+        return set(self.adjacency)
+
+
+class FakeDecomposerMemgraph:
+    """In-memory stand-in for mini_memgraph.Memgraph answering the in-memory decomposer's reads and writes."""
+
+    def __init__(self, edges: List[tuple], nodes: List[int] = None):
+        self.nodes = list(nodes) if nodes is not None else sorted({node for edge in edges for node in edge})
+        self.edges = list(edges)
+        self.properties = {node: {'decomposed': None, 'decomp_degree': None} for node in self.nodes}
+        self.cores = []
+
+    def set_index(self, *args, **kwargs):
+        pass
+
+    def node_count(self, *args, **kwargs) -> int:
+        return len(self.nodes)
+
+    def read(self, query: str, **kwargs):
+        if 'RETURN n.id AS id' in query:
+            return [{'id': node, 'decomposed': self.properties[node]['decomposed'],
+                     'degree': self.properties[node]['decomp_degree']} for node in self.nodes] or None
+        if 'RETURN s.id AS source, t.id AS target' in query:
+            return [{'source': s, 'target': t} for u, v in self.edges for s, t in ((u, v), (v, u))] or None
+        if query.startswith('MATCH (n:META:'):
+            return None
+        raise NotImplementedError(query)
+
+    def write(self, query: str, **kwargs):
+        if 'UNWIND $rows' in query:
+            for row in kwargs['rows']:
+                self.properties[row['id']] = {'decomposed': row['decomposed'], 'decomp_degree': row['degree']}
+        elif 'UNWIND $ids' in query:
+            self.cores.extend(kwargs['ids'])
+        elif not query.startswith('CREATE (n:META:'):
+            raise NotImplementedError(query)
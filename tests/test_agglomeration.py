@@ -0,0 +1,44 @@
+import pytest
+
+from squashy.agglomeration import GraphAgglomerator
+from fakes import FakeMemgraph
+
+
+def assignments(database):
+    return sorted((core, node, distance) for node, (core, distance) in database.rels.items())
+
+
+@pytest.mark.parametrize('keep_frontier_rings', [False, True])
+def test_frontier_rings_are_not_replayed_across_minimum_degrees(keep_frontier_rings):
+    database = FakeMemgraph([(0, 1), (1, 2), (2, 3)], cores=[0])
+    agglomerator = GraphAgglomerator(database, 'NODE', 'REL', n_workers=1, min_hops=1, max_hops=3,
+                                     keep_frontier_rings=keep_frontier_rings)
+    agglomerator.set_minimum_degree(1)
+    agglomerator.agglomerate()
+    assert assignments(database) == [(0, 0, 0), (0, 1, 1), (0, 2, 2), (0, 3, 3)]
+
+    agglomerator.set_minimum_degree(2)
+    agglomerator.agglomerate()
+    assert assignments(database) == [(0, 0, 0), (0, 1, 1), (0, 2, 2)]
+
+
+def test_reset_removes_the_eligibility_label():
+    database = FakeMemgraph([(0, 1), (1, 2), (2, 3)], cores=[0])
+    agglomerator = GraphAgglomerator(database, 'NODE', 'REL', n_workers=1)
+    agglomerator.set_minimum_degree(2)
+    assert database.labels[agglomerator.eligible_label] == {1, 2}
+
+    agglomerator.reset()
+    assert agglomerator.eligible_label not in database.labels
+
+    agglomerator.agglomerate()
+    assert assignments(database) == [(0, 0, 0), (0, 1, 1), (0, 2, 2)]
+
+
+def test_hop_distances_beyond_int8_are_stored():
+    edges = [(node, node + 1) for node in range(200)]
+    database = FakeMemgraph(edges, cores=[0])
+    agglomerator = GraphAgglomerator(database, 'NODE', 'REL', n_workers=1, min_hops=1, max_hops=150)
+    agglomerator.agglomerate()
+    assert database.rels[150] == (0, 150)
+    assert 151 not in database.rels
@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+import pytest
+
+from squashy.decomposition import KCoreIdentifier
+from fakes import FakeDecomposerMemgraph
+
+
+def reference_peel(nodes, edges, k, max_cores):
+    """Replays the Cypher decomposer query by query on plain Python sets."""
+    neighbours = {node: [] for node in nodes}
+    for u, v in edges:
+        neighbours[u].append(v)
+        neighbours[v].append(u)
+    decomposed, degree, cores = set(), {}, []
+
+    def run_pass():
+        for node in nodes:
+            if node in decomposed:
+                continue
+            live = sum(1 for neighbour in neighbours[node] if neighbour not in decomposed)
+            if live > 0:
+                degree[node] = live
+        remaining = [degree[node] for node in nodes if node not in decomposed and node in degree]
+        n_remaining = sum(1 for node in nodes if node not in decomposed)
+        return n_remaining, min(remaining, default=0), max(remaining, default=0)
+
+    n_remaining, min_degree, max_degree = run_pass()
+    while min_degree < k and len(cores) < max_cores and n_remaining > 0:
+        pruned = [node for node in nodes if node not in decomposed and degree.get(node, k) < k]
+        decomposed.update(pruned)
+        if n_remaining < 1:
+            break
+        n_remaining, min_degree, max_degree = run_pass()
+        if not pruned and min_degree < k:
+            break
+        while min_degree >= k and len(cores) < max_cores:
+            candidates = [node for node in nodes if node not in decomposed and degree.get(node) == max_degree]
+            if candidates:
+                cores.append(candidates[0])
+                decomposed.add(candidates[0])
+            else:
+                cores.append(None)
+            n_remaining, min_degree, max_degree = run_pass()
+    return [core for core in cores if core is not None], decomposed, degree
+
+
+def random_graph(n_nodes, n_edges, seed):
+    rng = random.Random(seed)
+    edges = set()
+    while len(edges) < n_edges:
+        u, v = rng.sample(range(n_nodes), 2)
+        edges.add((min(u, v), max(u, v)))
+    return list(range(n_nodes)), sorted(edges)
+
+
+def make_identifier(database, k=2, max_cores=500):
+    return KCoreIdentifier(database, 'NODE', 'REL', k=k, max_cores=max_cores, in_memory=True)
+
+
+def test_load_graph_builds_reverse_adjacency_and_live_degree():
+    database = FakeDecomposerMemgraph([(0, 1), (1, 2), (1, 3)], nodes=[0, 1, 2, 3])
+    database.properties[3]['decomposed'] = True
+    identifier = make_identifier(database)
+    identifier._load_graph()
+
+    assert identifier._alive.tolist() == [True, True, True, False]
+    assert identifier._live_degree.tolist() == [1, 2, 1, 1]
+    for node, expected in enumerate([[1], [0, 2, 3], [1], [1]]):
+        start, end = identifier._rev_indptr[node], identifier._rev_indptr[node + 1]
+        assert sorted(identifier._rev_indices[start:end].tolist()) == expected
+
+
+def test_remove_nodes_decrements_neighbour_live_degree():
+    nodes, edges = random_graph(30, 80, seed=1)
+    identifier = make_identifier(FakeDecomposerMemgraph(edges, nodes))
+    identifier._load_graph()
+    removed = np.array([0, 3, 7, 11])
+    identifier._remove_nodes(removed)
+
+    gone = set(removed.tolist())
+    expected = [sum(1 for u, v in edges for s, t in ((u, v), (v, u)) if s == node and t not in gone)
+                for node in nodes]
+    assert identifier._live_degree.tolist() == expected
+    assert not identifier._alive[removed].any()
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('k, max_cores', [(2, 500), (3, 5), (4, 20)])
+def test_in_memory_peel_matches_reference(seed, k, max_cores):
+    nodes, edges = random_graph(40, 110, seed=seed)
+    database = FakeDecomposerMemgraph(edges, nodes)
+    identifier = make_identifier(database, k=k, max_cores=max_cores)
+    identifier.identify_core_nodes()
+
+    cores, decomposed, degree = reference_peel(nodes, edges, k, max_cores)
+    assert database.cores == cores
+    assert {node for node, props in database.properties.items() if props['decomposed']} == decomposed
+    assert {node: props['decomp_degree'] for node, props in database.properties.items()
+            if props['decomp_degree'] is not None} == degree
+
+
+def test_in_memory_peel_releases_graph_state():
+    nodes, edges = random_graph(20, 40, seed=0)
+    identifier = make_identifier(FakeDecomposerMemgraph(edges, nodes))
+    identifier.identify_core_nodes()
+
+    for attr in ('_ids', '_index', '_alive', '_degree', '_live_degree', '_rev_indptr', '_rev_indices'):
+        assert not hasattr(identifier, attr)
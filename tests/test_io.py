@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+
+from squashy.agglomeration import GraphAgglomerator
+from squashy.io import AssignmentCache
+from fakes import FakeMemgraph
+
+
+def test_assignment_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'assignments.sqlite')
+    cache = AssignmentCache(path)
+    cache.clear('run-a')
+    cache.append([(1, 0, 0), (2, 0, 1), ('x', 'c', 2)])
+    cache.connection.close()
+
+    reopened = AssignmentCache(path)
+    assert reopened.run_key == 'run-a'
+    assert reopened.count() == 3
+    assert sorted(reopened.load(), key=str) == sorted([(1, 0, 0), (2, 0, 1), ('x', 'c', 2)], key=str)
+
+    reopened.drop_from_distance(1)
+    assert reopened.load() == [(1, 0, 0)]
+
+
+def test_assignment_cache_overwrites_rows_and_key(tmp_path):
+    cache = AssignmentCache(str(tmp_path / 'assignments.sqlite'))
+    cache.clear('run-a')
+    cache.append([(1, 0, 1)])
+    cache.append([(1, 5, 2)])
+    assert cache.load() == [(1, 5, 2)]
+
+    cache.clear('run-a')
+    assert cache.count() == 0
+    assert cache.run_key == 'run-a'
+
+    cache.clear()
+    assert cache.run_key is None
+
+
+def test_assignment_cache_missing_file_starts_empty(tmp_path):
+    path = tmp_path / 'new.sqlite'
+    assert not path.exists()
+    cache = AssignmentCache(str(path))
+    assert path.exists()
+    assert cache.count() == 0
+    assert cache.load() == []
+    assert cache.run_key is None
+
+    with pytest.raises(sqlite3.OperationalError):
+        AssignmentCache(str(tmp_path / 'missing' / 'cache.sqlite'))
+
+
+def test_assignment_cache_is_ignored_on_run_key_mismatch(tmp_path):
+    path = str(tmp_path / 'assignments.sqlite')
+    database = FakeMemgraph([(0, 1), (1, 2), (2, 3), (3, 4)], cores=[0, 4])
+    agglomerator = GraphAgglomerator(database, 'NODE', 'REL', n_workers=1, assignments_path=path)
+    agglomerator.agglomerate()
+    saved = {node: dict(core=core, distance=distance) for node, (core, distance) in database.rels.items()}
+    assert agglomerator.load_assignments() == saved
+
+    stale = AssignmentCache(path)
+    stale.clear('another-run')
+    stale.append([(node, 4 - data['core'], data['distance']) for node, data in saved.items()])
+    assert stale.count() == agglomerator.count_saved_assignments()
+
+    assert agglomerator.load_assignments() == saved
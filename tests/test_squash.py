@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+import squashy.squash
+from squashy.agglomeration import GraphAgglomerator, MetaRelate
+from squashy.squash import Squash
+from fakes import FakeMemgraph
+
+PATH_EDGES = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+
+
+@pytest.fixture
+def squash(monkeypatch):
+    database = FakeMemgraph(PATH_EDGES, cores=[0, 6])
+    monkeypatch.setattr(squashy.squash, 'SessionMemgraph', lambda **kwargs: database)
+    decomposer = MagicMock(node_label='NODE', rel_label='REL', core_label='CORE', target_label=None,
+                           orientation='undirected', filter_attr='decomposed', degree_label='decomp_degree',
+                           in_memory=False)
+    meta_relator = MagicMock(node='NODE', rel='REL', core='CORE', represents='REPRESENTS', weight=None,
+                             orientation='undirected')
+    meta_relator.count_meta_relations.return_value = 1
+    agglomerator = GraphAgglomerator(database, 'NODE', 'REL', n_workers=1)
+    return Squash('NODE', 'REL', decomposer=decomposer, agglomerator=agglomerator, meta_relator=meta_relator)
+
+
+def test_repeat_squash_graph_is_skipped_after_a_resumed_run(squash):
+    squash.agglomerator.agglomerate()
+
+    squash.squash_graph(pipelined=False)
+    assert not squash.last_run_stats['skipped']
+    assert squash.agglomerator.hop_range == (1, 3)
+
+    squash.squash_graph(pipelined=False)
+    assert squash.last_run_stats['skipped']
+    assert squash.db.rels
+
+
+def test_cached_core_lists_are_not_mutated_through_returned_records(squash):
+    squash.meta_relator.cutoff_score = 0.5
+    squash.meta_relator.edge_columns = MetaRelate.edge_columns
+    squash.meta_relator.get_core_edge_list.return_value = [{'source': 0, 'target': 6, 'weight': 1,
+                                                            'n_distinct': 1, 'score': 1.0}]
+    squash.meta_relator.get_core_node_list.return_value = [{'id': 0, 'n_subnodes': 4}]
+
+    squash.get_core_edge_list()[0]['weight'] = 99
+    next(squash.iter_core_edges())['score'] = 99
+    squash.get_core_node_list()[0]['n_subnodes'] = 99
+
+    assert squash.get_core_edge_list() == [{'source': 0, 'target': 6, 'weight': 1, 'n_distinct': 1, 'score': 1.0}]
+    assert squash.get_core_edge_frame()['score'].tolist() == [1.0]
+    assert squash.get_core_node_list() == [{'id': 0, 'n_subnodes': 4}]
+    assert squash.meta_relator.get_core_edge_list.call_count == 1